@@ -200,6 +200,112 @@ class Subscope(Statement):
         raise ValueError("cannot evaluate a subscope directly!")
 
 
+# opcodes of compiled statement programs, see `compile_statement`.
+#
+# most features evaluate as a membership test against the feature set,
+#  which OP_FEATURE performs inline without a method call.
+# features with custom matching logic (regex, bytes) and range statements
+#  defer to their `evaluate` method via OP_EVAL,
+#  using only the boolean result.
+OP_FEATURE = 0  # operand: feature; push whether it is present in the feature set
+OP_EVAL = 1  # operand: node; push bool(node.evaluate(ctx))
+OP_AND = 2  # operand: child count; pop the children, push whether all are True
+OP_OR = 3  # operand: child count; pop the children, push whether any is True
+OP_NOT = 4  # invert the top of the stack
+OP_SOME = 5  # operand: (count, child count); pop the children, push whether at least count are True
+
+
+def compile_statement(statement):
+    """
+    flatten the given statement tree into a post-order program for `evaluate_program`.
+
+    args:
+      statement (capa.engine.Statement or capa.features.Feature)
+
+    returns:
+      List[Tuple[int, object]]: sequence of (opcode, operand)
+    """
+    program = []
+
+    def emit(node):
+        if isinstance(node, Subscope):
+            raise ValueError("cannot evaluate a subscope directly!")
+        elif isinstance(node, Range):
+            program.append((OP_EVAL, node))
+        elif isinstance(node, And):
+            for child in node.children:
+                emit(child)
+            program.append((OP_AND, len(node.children)))
+        elif isinstance(node, Or):
+            for child in node.children:
+                emit(child)
+            program.append((OP_OR, len(node.children)))
+        elif isinstance(node, Not):
+            emit(node.child)
+            program.append((OP_NOT, None))
+        elif isinstance(node, Some):
+            for child in node.children:
+                emit(child)
+            program.append((OP_SOME, (node.count, len(node.children))))
+        elif type(node).evaluate is capa.features.Feature.evaluate:
+            program.append((OP_FEATURE, node))
+        else:
+            program.append((OP_EVAL, node))
+
+    emit(statement)
+    return program
+
+
+def evaluate_program(program, ctx):
+    """
+    evaluate a program compiled by `compile_statement` against the given feature set.
+
+    this computes only whether the statement matches - no `Result` tree -
+     by iterating the flat program with a small value stack,
+     instead of recursing through `evaluate` methods.
+    use it to cheaply screen statements, which mostly don't match,
+     before collecting full results for rendering.
+
+    args:
+      program (List[Tuple[int, object]]): see `compile_statement`.
+      ctx (defaultdict[Feature, set[VA]])
+
+    returns:
+      bool
+    """
+    stack = []
+    for op, arg in program:
+        if op == OP_FEATURE:
+            stack.append(arg in ctx)
+        elif op == OP_EVAL:
+            stack.append(bool(arg.evaluate(ctx)))
+        elif op == OP_AND:
+            if arg:
+                success = all(stack[-arg:])
+                del stack[-arg:]
+            else:
+                success = True
+            stack.append(success)
+        elif op == OP_OR:
+            if arg:
+                success = any(stack[-arg:])
+                del stack[-arg:]
+            else:
+                success = False
+            stack.append(success)
+        elif op == OP_NOT:
+            stack[-1] = not stack[-1]
+        else:  # OP_SOME
+            count, children = arg
+            if children:
+                success = sum(stack[-children:]) >= count
+                del stack[-children:]
+            else:
+                success = 0 >= count
+            stack.append(success)
+    return stack[0]
+
+
 def topologically_order_rules(rules):
     """
     order the given rules such that dependencies show up before dependents.
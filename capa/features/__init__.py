@@ -123,6 +123,83 @@ class String(Feature):
         super(String, self).__init__(value, description=description)
 
 
+def _extract_required_literal(pat, flags):
+    """
+    extract a substring that every match of the given pattern must contain, or None.
+
+    the literal serves as a cheap `in` prefilter before running the regex,
+     which skips most candidate strings without entering the regex engine.
+    extraction is conservative - when in doubt, no literal is returned:
+      - alternation and groups can make any part optional, so such patterns are skipped
+      - case-insensitive patterns are skipped, since `in` is case-sensitive
+      - escapes of punctuation count as literal characters;
+        shorthand classes like \\d and numeric escapes end the attempt
+      - a character followed by a quantifier is dropped from its run
+    """
+    if flags & re.IGNORECASE:
+        return None
+    if "|" in pat or "(" in pat or ")" in pat:
+        return None
+
+    literals = []
+    run = []
+    i = 0
+    n = len(pat)
+    while i < n:
+        c = pat[i]
+        if c == "\\":
+            if i + 1 < n and not pat[i + 1].isalnum():
+                # escaped punctuation, like `\.`, matches that character literally.
+                run.append(pat[i + 1])
+                i += 2
+            else:
+                # shorthand class or numeric escape, like `\d` or `\x41`:
+                #  too hairy to reason about, give up.
+                return None
+        elif c == "[":
+            # a character class matches a single, unknown character: end the current run.
+            literals.append(run)
+            run = []
+            i += 1
+            if i < n and pat[i] == "^":
+                i += 1
+            if i < n and pat[i] == "]":
+                # a leading "]" is a member, not the terminator
+                i += 1
+            while i < n and pat[i] != "]":
+                i += 2 if pat[i] == "\\" else 1
+            i += 1
+        elif c in "?*{":
+            # the quantifier makes the preceding character optional or repeated,
+            #  so it is not a required part of the run.
+            if run:
+                run.pop()
+            literals.append(run)
+            run = []
+            if c == "{":
+                while i < n and pat[i] != "}":
+                    i += 1
+            i += 1
+        elif c == "+":
+            # one-or-more: the preceding character remains required,
+            #  but adjacency with what follows is not guaranteed.
+            literals.append(run)
+            run = []
+            i += 1
+        elif c in ".^$":
+            # `.` matches an unknown character; `^` and `$` anchor without consuming.
+            literals.append(run)
+            run = []
+            i += 1
+        else:
+            run.append(c)
+            i += 1
+    literals.append(run)
+
+    longest = max(literals, key=len)
+    return "".join(longest) if longest else None
+
+
 class Regex(String):
     def __init__(self, value, description=None):
         super(Regex, self).__init__(value, description=description)
@@ -133,6 +210,8 @@ class Regex(String):
             flags |= re.IGNORECASE
         try:
             self.re = re.compile(pat, flags)
+            # substring that every match must contain, used to prefilter in `evaluate`.
+            self.prefilter = _extract_required_literal(pat, flags)
         except re.error:
             if value.endswith("/i"):
                 value = value[: -len("i")]
@@ -146,6 +225,11 @@ class Regex(String):
             if not isinstance(feature, (capa.features.String,)):
                 continue
 
+            # a required literal, when one could be extracted from the pattern,
+            # cheaply rules out most candidate strings before entering the regex engine.
+            if self.prefilter is not None and self.prefilter not in feature.value:
+                continue
+
             # `re.search` finds a match anywhere in the given string
             # which implies leading and/or trailing whitespace.
             # using this mode cleans is more convenient for rule authors,
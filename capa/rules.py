@@ -6,14 +6,34 @@
 #  is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import io
+import os
+import re
 import uuid
 import codecs
+import pickle
+import hashlib
 import logging
 import binascii
 import functools
 
 import six
-import ruamel.yaml
+import yaml
+
+try:
+    # prefer the libyaml (C extension) loader when available.
+    # it parses rule documents roughly an order of magnitude faster
+    #  than the pure Python loader, which dominates ruleset load time.
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
+try:
+    # optional: when available, all regex features in a rule set can be compiled
+    #  into a single hyperscan database and scanned in one pass, see `RuleSet.match_strings`.
+    import hyperscan
+except ImportError:
+    hyperscan = None
 
 import capa.engine
 import capa.features
@@ -97,6 +117,21 @@ SUPPORTED_FEATURES = {
 # all basic block scope features are also function scope features
 SUPPORTED_FEATURES[FUNCTION_SCOPE].update(SUPPORTED_FEATURES[BASIC_BLOCK_SCOPE])
 
+# the characteristic values supported at each scope, precomputed from `SUPPORTED_FEATURES`.
+# validating a characteristic is then a string set lookup,
+#  rather than constructing a throwaway Characteristic instance per check.
+_SUPPORTED_CHARACTERISTICS = {
+    scope: set(feature.value for feature in features if isinstance(feature, capa.features.Characteristic))
+    for scope, features in SUPPORTED_FEATURES.items()
+}
+
+# the feature types supported at each scope, precomputed from `SUPPORTED_FEATURES`
+#  into the tuple form that `isinstance` accepts.
+_SUPPORTED_FEATURE_TYPES = {
+    scope: tuple(feature for feature in features if isinstance(feature, type))
+    for scope, features in SUPPORTED_FEATURES.items()
+}
+
 
 class InvalidRule(ValueError):
     def __init__(self, msg):
@@ -135,16 +170,20 @@ class InvalidRuleSet(ValueError):
 
 def ensure_feature_valid_for_scope(scope, feature):
     if isinstance(feature, capa.features.Characteristic):
-        if capa.features.Characteristic(feature.value) not in SUPPORTED_FEATURES[scope]:
+        if feature.value not in _SUPPORTED_CHARACTERISTICS[scope]:
             raise InvalidRule("feature %s not support for scope %s" % (feature, scope))
-    elif not isinstance(feature, tuple(filter(lambda t: isinstance(t, type), SUPPORTED_FEATURES[scope]))):
+    elif not isinstance(feature, _SUPPORTED_FEATURE_TYPES[scope]):
         raise InvalidRule("feature %s not support for scope %s" % (feature, scope))
 
 
 def parse_int(s):
-    if s.startswith("0x"):
-        return int(s, 0x10)
-    else:
+    # base 0 auto-detects the "0x" prefix in a single C-level parse,
+    #  rather than probing the prefix in Python first.
+    try:
+        return int(s, 0)
+    except ValueError:
+        # base 0 rejects decimals with leading zeros, like "010";
+        #  keep accepting those as base 10.
         return int(s, 10)
 
 
@@ -186,46 +225,43 @@ def parse_range(s):
     return min, max
 
 
+# mapping from feature keyword to feature constructor.
+# keep this in sync with supported features.
+#
+# `parse_feature` is invoked for every feature node during rule parsing,
+#  so we dispatch via a single dict lookup rather than a chain of comparisons.
+_FEATURE_CONSTRUCTORS = {
+    "api": capa.features.insn.API,
+    "string": capa.features.StringFactory,
+    "bytes": capa.features.Bytes,
+    "number": capa.features.insn.Number,
+    "offset": capa.features.insn.Offset,
+    "mnemonic": capa.features.insn.Mnemonic,
+    "basic blocks": capa.features.basicblock.BasicBlock,
+    "characteristic": capa.features.Characteristic,
+    "export": capa.features.file.Export,
+    "import": capa.features.file.Import,
+    "section": capa.features.file.Section,
+    "match": capa.features.MatchedRule,
+}
+
+
 def parse_feature(key):
-    # keep this in sync with supported features
-    if key == "api":
-        return capa.features.insn.API
-    elif key == "string":
-        return capa.features.StringFactory
-    elif key == "bytes":
-        return capa.features.Bytes
-    elif key == "number":
-        return capa.features.insn.Number
-    elif key.startswith("number/"):
-        arch = key.partition("/")[2]
+    Feature = _FEATURE_CONSTRUCTORS.get(key)
+    if Feature is not None:
+        return Feature
+
+    if key.startswith("number/") or key.startswith("offset/"):
+        term, _, arch = key.partition("/")
         # the other handlers here return constructors for features,
         # and we want to as well,
         # however, we need to preconfigure one of the arguments (`arch`).
         # so, instead we return a partially-applied function that
         #  provides `arch` to the feature constructor.
         # it forwards any other arguments provided to the closure along to the constructor.
-        return functools.partial(capa.features.insn.Number, arch=arch)
-    elif key == "offset":
-        return capa.features.insn.Offset
-    elif key.startswith("offset/"):
-        arch = key.partition("/")[2]
-        return functools.partial(capa.features.insn.Offset, arch=arch)
-    elif key == "mnemonic":
-        return capa.features.insn.Mnemonic
-    elif key == "basic blocks":
-        return capa.features.basicblock.BasicBlock
-    elif key == "characteristic":
-        return capa.features.Characteristic
-    elif key == "export":
-        return capa.features.file.Export
-    elif key == "import":
-        return capa.features.file.Import
-    elif key == "section":
-        return capa.features.file.Section
-    elif key == "match":
-        return capa.features.MatchedRule
-    else:
-        raise InvalidRule("unexpected statement: %s" % key)
+        return functools.partial(_FEATURE_CONSTRUCTORS[term], arch=arch)
+
+    raise InvalidRule("unexpected statement: %s" % key)
 
 
 # this is the separator between a feature value and its description
@@ -272,54 +308,99 @@ def parse_description(s, value_type, description=None):
     return value, description
 
 
-def build_statements(d, scope):
-    if len(d.keys()) > 2:
+# statement keys that carry an argument: `N or more` and `count(...)`.
+# see `build_statements`.
+_STATEMENT_KEY_RE = re.compile(r"^(?:(?P<count>\d+) or more|count\((?P<term>.+)\))$")
+
+
+def build_statements(d, scope, subscope_seen=None):
+    # when the caller provides `subscope_seen`, a single-element list,
+    #  it is flipped to [True] upon encountering a subscope statement.
+    # `Rule.from_dict` uses this to record, at parse time,
+    #  whether subscope extraction has any work to do for the rule.
+    #
+    # a statement node is a mapping with the statement key and, optionally, a description.
+    # `build_statements` recurses for every node in every rule,
+    #  so fetch the key and value in a single pass over the dict
+    #  rather than materializing `d.keys()` views.
+    if len(d) > 2:
         raise InvalidRule("too many statements")
 
-    key = list(d.keys())[0]
+    # raise before fetching the key: a bare StopIteration from `next` would be
+    #  swallowed by the `map` in `RuleSet.from_directory` and truncate the ruleset.
+    if not d:
+        raise InvalidRule("empty statement")
+
+    key = next(iter(d))
+    val = d[key]
     if key == "and":
-        return And([build_statements(dd, scope) for dd in d[key]], description=d.get("description"))
+        return And([build_statements(dd, scope, subscope_seen) for dd in val], description=d.get("description"))
     elif key == "or":
-        return Or([build_statements(dd, scope) for dd in d[key]], description=d.get("description"))
+        return Or([build_statements(dd, scope, subscope_seen) for dd in val], description=d.get("description"))
     elif key == "not":
-        if len(d[key]) != 1:
+        if len(val) != 1:
             raise InvalidRule("not statement must have exactly one child statement")
-        return Not(build_statements(d[key][0], scope), description=d.get("description"))
-    elif key.endswith(" or more"):
-        count = int(key[: -len("or more")])
-        return Some(count, [build_statements(dd, scope) for dd in d[key]], description=d.get("description"))
+        return Not(build_statements(val[0], scope, subscope_seen), description=d.get("description"))
     elif key == "optional":
         # `optional` is an alias for `0 or more`
         # which is useful for documenting behaviors,
         # like with `write file`, we might say that `WriteFile` is optionally found alongside `CreateFileA`.
-        return Some(0, [build_statements(dd, scope) for dd in d[key]], description=d.get("description"))
+        return Some(0, [build_statements(dd, scope, subscope_seen) for dd in val], description=d.get("description"))
 
     elif key == "function":
         if scope != FILE_SCOPE:
             raise InvalidRule("function subscope supported only for file scope")
 
-        if len(d[key]) != 1:
+        if len(val) != 1:
             raise InvalidRule("subscope must have exactly one child statement")
 
-        return Subscope(FUNCTION_SCOPE, build_statements(d[key][0], FUNCTION_SCOPE))
+        if subscope_seen is not None:
+            subscope_seen[0] = True
+
+        return Subscope(FUNCTION_SCOPE, build_statements(val[0], FUNCTION_SCOPE, subscope_seen))
 
     elif key == "basic block":
         if scope != FUNCTION_SCOPE:
             raise InvalidRule("basic block subscope supported only for function scope")
 
-        if len(d[key]) != 1:
+        if len(val) != 1:
             raise InvalidRule("subscope must have exactly one child statement")
 
-        return Subscope(BASIC_BLOCK_SCOPE, build_statements(d[key][0], BASIC_BLOCK_SCOPE))
+        if subscope_seen is not None:
+            subscope_seen[0] = True
+
+        return Subscope(BASIC_BLOCK_SCOPE, build_statements(val[0], BASIC_BLOCK_SCOPE, subscope_seen))
+
+    elif key == "string" and not isinstance(val, six.string_types):
+        raise InvalidRule("ambiguous string value %s, must be defined as explicit string" % val)
+
+    # the remaining statement keys carry an argument, like `5 or more` and `count(...)`.
+    # a single precompiled match recognizes them,
+    #  replacing several startswith/endswith string probes per node.
+    m = _STATEMENT_KEY_RE.match(key)
+    if m is None:
+        Feature = parse_feature(key)
+        value, description = parse_description(val, key, d.get("description"))
+        try:
+            feature = Feature(value, description=description)
+        except ValueError as e:
+            raise InvalidRule(str(e))
+        ensure_feature_valid_for_scope(scope, feature)
+        return feature
+
+    elif m.group("count") is not None:
+        # `N or more`
+        count = int(m.group("count"))
+        return Some(count, [build_statements(dd, scope, subscope_seen) for dd in val], description=d.get("description"))
 
-    elif key.startswith("count(") and key.endswith(")"):
-        # e.g.:
+    else:
+        # `count(...)`, e.g.:
         #
         #     count(basic block)
         #     count(mnemonic(mov))
         #     count(characteristic(nzxor))
 
-        term = key[len("count(") : -len(")")]
+        term = m.group("term")
 
         # when looking for the existence of such a feature, our rule might look like:
         #     - mnemonic: mov
@@ -349,7 +430,7 @@ def build_statements(d, scope):
             feature = Feature()
         ensure_feature_valid_for_scope(scope, feature)
 
-        count = d[key]
+        count = val
         if isinstance(count, int):
             return Range(feature, min=count, max=count, description=d.get("description"))
         elif count.endswith(" or more"):
@@ -365,17 +446,162 @@ def build_statements(d, scope):
             return Range(feature, min=min, max=max, description=d.get("description"))
         else:
             raise InvalidRule("unexpected range: %s" % (count))
-    elif key == "string" and not isinstance(d[key], six.string_types):
-        raise InvalidRule("ambiguous string value %s, must be defined as explicit string" % d[key])
+
+
+def _optimize_statement(statement):
+    """
+    simplify the given statement tree, preserving its evaluation semantics:
+      - nested and-of-and and or-of-or are flattened into the parent
+      - double negation is elided
+      - duplicate feature children of and/or are dropped (`X or X` === `X`)
+      - a single-child and/or is replaced by its child
+
+    nodes that carry a description are left intact,
+     so that rendered results keep the author's annotations.
+
+    returns the replacement for the given statement, possibly the same object.
+    """
+    if not isinstance(statement, Statement):
+        return statement
+
+    # optimize the children first so that simplifications cascade upwards.
+    if hasattr(statement, "child"):
+        statement.child = _optimize_statement(statement.child)
+    if hasattr(statement, "children"):
+        statement.children = [_optimize_statement(child) for child in statement.children]
+
+    if isinstance(statement, (And, Or)):
+        children = []
+        for child in statement.children:
+            if type(child) is type(statement) and child.description is None:
+                children.extend(child.children)
+            else:
+                children.append(child)
+
+        seen = set([])
+        unique = []
+        for child in children:
+            if isinstance(child, capa.features.Feature):
+                key = (type(child), child.name, child.value, child.arch, child.description)
+                if key in seen:
+                    continue
+                seen.add(key)
+            unique.append(child)
+        statement.children = unique
+
+        if len(unique) == 1 and statement.description is None:
+            return unique[0]
+
+    elif isinstance(statement, Not):
+        child = statement.child
+        if isinstance(child, Not) and statement.description is None and child.description is None:
+            return child.child
+
+    return statement
+
+
+def _statement_cost(node):
+    """
+    estimate the relative cost of evaluating the given statement or feature.
+
+    most features evaluate as a single hash lookup into the feature set,
+     while `bytes` and `regex` have to scan across all features in the set,
+     and statements cost roughly the sum of their children.
+    """
+    if isinstance(node, (capa.features.Regex, capa.features.Bytes)):
+        return 10
+    elif isinstance(node, Statement):
+        return 1 + sum(_statement_cost(child) for child in node.get_children())
     else:
-        Feature = parse_feature(key)
-        value, description = parse_description(d[key], key, d.get("description"))
-        try:
-            feature = Feature(value, description=description)
-        except ValueError as e:
-            raise InvalidRule(str(e))
-        ensure_feature_valid_for_scope(scope, feature)
-        return feature
+        return 1
+
+
+def _sort_statement_children(statement):
+    """
+    order the children of and/or statements from cheapest to most expensive to evaluate.
+
+    this way, evaluation strategies that stop early (like the short-circuiting matcher)
+     do the cheap, usually decisive, hash lookups before any regex or bytes scan.
+    the sort is stable, so children of equal cost keep their authored order.
+    this does not change what a statement matches.
+    """
+    if not isinstance(statement, Statement):
+        return
+
+    for child in statement.get_children():
+        _sort_statement_children(child)
+
+    if isinstance(statement, (And, Or)):
+        statement.children.sort(key=_statement_cost)
+
+
+def _intern_statements(rules):
+    """
+    share identical sub-statements across the given rules (hash-consing).
+
+    many rules repeat the same features and even whole logic subtrees,
+     such as `api: CreateFileA` or a common `and: [...]` block.
+    after this pass, each distinct subtree is represented by a single object,
+     which shrinks the resident size of a loaded ruleset
+     and lets future evaluation strategies memoize results per subtree.
+
+    this must run after subscope extraction and optimization,
+     since those passes mutate the statement trees.
+    """
+    cache = {}
+
+    def intern(node):
+        if isinstance(node, capa.features.Regex):
+            # regex nodes record their most recent match for rendering (`Regex.match`),
+            # so they cannot be shared.
+            return node
+
+        elif isinstance(node, capa.features.Feature):
+            key = ("feature", type(node), node.name, node.value, node.arch, node.description)
+
+        elif isinstance(node, Statement):
+            # intern the children first so that identical subtrees collapse bottom-up.
+            if hasattr(node, "child"):
+                node.child = intern(node.child)
+            if hasattr(node, "children"):
+                node.children = [intern(child) for child in node.children]
+
+            if isinstance(node, Some):
+                extra = node.count
+            elif isinstance(node, Range):
+                extra = (node.min, node.max)
+            elif isinstance(node, Subscope):
+                extra = node.scope
+            else:
+                extra = None
+
+            children = tuple(id(child) for child in node.get_children())
+            key = ("statement", type(node), node.description, extra, children)
+
+        else:
+            return node
+
+        return cache.setdefault(key, node)
+
+    for rule in rules:
+        rule.statement = intern(rule.statement)
+
+
+def _collect_regexes(rules):
+    """collect the distinct regex feature nodes found across the given rules."""
+    regexes = []
+    seen = set([])
+    for rule in rules:
+        stack = [rule.statement]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, capa.features.Regex):
+                if id(node) not in seen:
+                    seen.add(id(node))
+                    regexes.append(node)
+            elif isinstance(node, Statement):
+                stack.extend(node.get_children())
+    return regexes
 
 
 def first(s):
@@ -386,24 +612,96 @@ def second(s):
     return s[1]
 
 
-# we use the ruamel.yaml parser because it supports roundtripping of documents with comments.
-yaml = ruamel.yaml.YAML(typ="rt")
+# increment this whenever the pickled representation of rules changes,
+#  such as when `Rule` or the `Statement` classes gain or lose fields.
+# this invalidates existing rule cache entries.
+CACHE_VERSION = 3
 
 
-# use block mode, not inline json-like mode
-yaml.default_flow_style = False
+def _get_rule_cache_path(cache_dir, buf):
+    """compute the cache entry path for the given rule document contents."""
+    key = hashlib.sha256()
+    key.update(str(CACHE_VERSION).encode("utf-8"))
+    key.update(buf)
+    return os.path.join(cache_dir, "capa-rule-" + key.hexdigest() + ".pkl")
 
 
-# indent lists by two spaces below their parent
-#
-#     features:
-#       - or:
-#         - mnemonic: aesdec
-#         - mnemonic: vaesdec
-yaml.indent(sequence=2, offset=2)
+def _load_cached_rule(cache_dir, buf):
+    """
+    fetch the rule parsed from the given document from the cache.
+    returns None on a cache miss, including when the entry is unreadable,
+     in which case the caller should parse the document as usual.
+    """
+    path = _get_rule_cache_path(cache_dir, buf)
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        # the cache is best effort, so treat any unreadable entry as a miss.
+        # unpickling corrupt data raises a grab bag of exceptions,
+        #  e.g. KeyError on py2 and ValueError/ImportError/IndexError on py3,
+        #  not just UnpicklingError.
+        return None
+
+
+def _cache_rule(cache_dir, buf, rule):
+    """store the rule parsed from the given document into the cache, best effort."""
+    path = _get_rule_cache_path(cache_dir, buf)
+    # write to a temporary file and rename it into place,
+    # so that concurrent capa invocations never see a partial entry.
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp, "wb") as f:
+            pickle.dump(rule, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        # the cache is best effort: the directory may not be writable, disk full, etc.
+        logger.debug("unable to cache rule: %s", rule.name)
+
+
+# cached ruamel.yaml round-trip instance, see `_get_ruamel_yaml`.
+_rt_yaml = None
+
+
+def _get_ruamel_yaml():
+    """
+    fetch the shared ruamel.yaml round-trip parser, constructing it on first use.
+
+    we use the ruamel.yaml parser when reformatting rules (see `Rule.to_yaml`)
+    because it supports roundtripping of documents with comments.
+    its import and setup are comparatively expensive,
+     so we defer them until a rule is actually reformatted.
+    rule loading must use PyYAML (see `Rule.from_yaml`), which is much faster.
+    """
+    global _rt_yaml
+    if _rt_yaml is None:
+        import ruamel.yaml
+
+        rt_yaml = ruamel.yaml.YAML(typ="rt")
+
+        # use block mode, not inline json-like mode
+        rt_yaml.default_flow_style = False
+
+        # indent lists by two spaces below their parent
+        #
+        #     features:
+        #       - or:
+        #         - mnemonic: aesdec
+        #         - mnemonic: vaesdec
+        rt_yaml.indent(sequence=2, offset=2)
+
+        # avoid word wrapping
+        rt_yaml.width = 4096
 
-# avoid word wrapping
-yaml.width = 4096
+        _rt_yaml = rt_yaml
+    return _rt_yaml
+
+
+# the line that opens the features section of a rule document,
+#  used to split off the meta section for header-only parsing, see `Rule.meta_from_yaml`.
+_FEATURES_KEY_RE = re.compile(r"^ +features\s*:\s*$", re.MULTILINE)
 
 
 class Rule(object):
@@ -414,6 +712,13 @@ class Rule(object):
         self.statement = statement
         self.meta = meta
         self.definition = definition
+        # compiled form of `statement`, built lazily on first evaluation.
+        self._program = None
+        # whether the statement tree contains any subscope statements:
+        #  True, False, or None when not yet known.
+        # `from_dict` records this at parse time so that `extract_subscope_rules`
+        #  can skip the tree walk for the common no-subscope case.
+        self._has_subscope = None
 
     def __str__(self):
         return "Rule(name=%s)" % (self.name)
@@ -436,7 +741,12 @@ class Rule(object):
         """
         deps = set([])
 
-        def rec(statement):
+        # walk the statement tree with an explicit stack rather than recursing,
+        #  so that deeply nested rules can't exhaust the recursion limit.
+        stack = [self.statement]
+        while stack:
+            statement = stack.pop()
+
             if isinstance(statement, capa.features.MatchedRule):
                 # we're not sure at this point if the `statement.value` is
                 #  really a rule name or a namespace name (we use `MatchedRule` for both cases).
@@ -454,17 +764,23 @@ class Rule(object):
                     deps.add(statement.value)
 
             elif isinstance(statement, Statement):
-                for child in statement.get_children():
-                    rec(child)
+                stack.extend(statement.get_children())
 
             # else: might be a Feature, etc.
             # which we don't care about here.
 
-        rec(self.statement)
         return deps
 
     def _extract_subscope_rules_rec(self, statement):
-        if isinstance(statement, Statement):
+        # walk the logic tree with an explicit queue rather than recursing,
+        #  so that deeply nested rules can't exhaust the recursion limit.
+        queue = collections.deque([statement])
+        while queue:
+            statement = queue.popleft()
+
+            if not isinstance(statement, Statement):
+                continue
+
             # for each child that is a subscope,
             for subscope in filter(
                 lambda statement: isinstance(statement, capa.engine.Subscope), statement.get_children()
@@ -499,12 +815,10 @@ class Rule(object):
                 # and yield the new rule to our caller
                 yield new_rule
 
-            # now recurse to other nodes in the logic tree.
-            # note: we cannot recurse into the subscope sub-tree,
-            #  because its been replaced by a `match` statement.
-            for child in statement.get_children():
-                for new_rule in self._extract_subscope_rules_rec(child):
-                    yield new_rule
+            # now continue to other nodes in the logic tree.
+            # note: we do not descend into subscope sub-trees,
+            #  because they've been replaced by `match` statements.
+            queue.extend(statement.get_children())
 
     def extract_subscope_rules(self):
         """
@@ -527,10 +841,28 @@ class Rule(object):
         #   replace old node with reference to new rule
         #   yield new rule
 
+        if self._has_subscope is False:
+            # parsing recorded that there's no subscope statement here,
+            #  so don't bother walking the tree.
+            return
+
         for new_rule in self._extract_subscope_rules_rec(self.statement):
             yield new_rule
 
+        # any subscopes have now been replaced with `match` statements.
+        self._has_subscope = False
+
     def evaluate(self, features):
+        # first, screen with a compiled form of the logic tree,
+        #  which computes only a boolean and skips building the `Result` tree.
+        # most rules don't match a given feature set, so this usually settles it;
+        #  only matches pay for the full evaluation that rendering needs.
+        if self._program is None:
+            self._program = capa.engine.compile_statement(self.statement)
+
+        if not capa.engine.evaluate_program(self._program, features):
+            return False
+
         return self.statement.evaluate(features)
 
     @classmethod
@@ -552,20 +884,78 @@ class Rule(object):
         if scope not in SUPPORTED_FEATURES.keys():
             raise InvalidRule("{:s} is not a supported scope".format(scope))
 
-        return cls(name, scope, build_statements(statements[0], scope), d["rule"]["meta"], s)
+        subscope_seen = [False]
+        rule = cls(name, scope, build_statements(statements[0], scope, subscope_seen), d["rule"]["meta"], s)
+        rule._has_subscope = subscope_seen[0]
+        return rule
 
     @classmethod
     def from_yaml(cls, s):
-        return cls.from_dict(yaml.load(s), s)
+        return cls.from_dict(yaml.load(s, Loader=_SafeLoader), s)
+
+    @classmethod
+    def meta_from_yaml(cls, s):
+        """
+        parse only the meta section of the given rule document.
+
+        rules put their meta section before the features section,
+         so we can parse just that prefix of the document
+         and skip tokenizing the (usually much larger) logic tree.
+        this is useful to pre-filter a large rule collection by metadata
+         without paying for full rule construction.
+
+        when the document doesn't follow that layout, fall back to a full parse.
+
+        returns:
+          Dict[str, Any]: the rule meta, like `Rule.meta`.
+        """
+        m = _FEATURES_KEY_RE.search(s)
+        if m:
+            try:
+                return yaml.load(s[: m.start()], Loader=_SafeLoader)["rule"]["meta"]
+            except (yaml.YAMLError, KeyError, TypeError):
+                pass
+
+        try:
+            return yaml.load(s, Loader=_SafeLoader)["rule"]["meta"]
+        except (yaml.YAMLError, KeyError, TypeError):
+            raise InvalidRule("rule must contain a meta section")
 
     @classmethod
-    def from_yaml_file(cls, path):
+    def meta_from_yaml_file(cls, path):
+        """parse only the meta section of the rule document at the given path, see `meta_from_yaml`."""
         with open(path, "rb") as f:
             try:
-                return cls.from_yaml(f.read().decode("utf-8"))
+                return cls.meta_from_yaml(f.read().decode("utf-8"))
             except InvalidRule as e:
                 raise InvalidRuleWithPath(path, str(e))
 
+    @classmethod
+    def from_yaml_file(cls, path, cache_dir=None):
+        """
+        load the rule from the given file.
+
+        when `cache_dir` is provided, consult an on-disk cache of parsed rules,
+         keyed by the file contents, to skip YAML parsing on warm runs.
+        """
+        with open(path, "rb") as f:
+            buf = f.read()
+
+        if cache_dir is not None:
+            rule = _load_cached_rule(cache_dir, buf)
+            if rule is not None:
+                return rule
+
+        try:
+            rule = cls.from_yaml(buf.decode("utf-8"))
+        except InvalidRule as e:
+            raise InvalidRuleWithPath(path, str(e))
+
+        if cache_dir is not None:
+            _cache_rule(cache_dir, buf, rule)
+
+        return rule
+
     def to_yaml(self):
         # reformat the yaml document with a common style.
         # this includes:
@@ -576,7 +966,8 @@ class Rule(object):
         # but not for rule logic.
         # programmatic generation of rules is not yet supported.
 
-        definition = yaml.load(self.definition)
+        rt_yaml = _get_ruamel_yaml()
+        definition = rt_yaml.load(self.definition)
         # definition retains a reference to `meta`,
         # so we're updating that in place.
         definition["rule"]["meta"] = self.meta
@@ -617,15 +1008,17 @@ class Rule(object):
         for key in hidden_meta.keys():
             del meta[key]
 
-        ostream = six.BytesIO()
-        yaml.dump(definition, ostream)
+        # ruamel.yaml emits str documents natively,
+        #  so collect them directly rather than round-tripping through UTF-8 bytes.
+        ostream = io.StringIO()
+        rt_yaml.dump(definition, ostream)
 
         for key, value in hidden_meta.items():
             if value is None:
                 continue
             meta[key] = value
 
-        return ostream.getvalue().decode("utf-8").rstrip("\n") + "\n"
+        return ostream.getvalue().rstrip("\n") + "\n"
 
 
 def get_rules_with_scope(rules, scope):
@@ -656,17 +1049,21 @@ def get_rules_and_dependencies(rules, rule_name):
     # we evaluate `rules` multiple times, so if its a generator, realize it into a list.
     rules = list(rules)
     namespaces = index_rules_by_namespace(rules)
-    rules = {rule.name: rule for rule in rules}
-    wanted = set([rule_name])
+    rules_by_name = {rule.name: rule for rule in rules}
 
-    def rec(rule):
-        wanted.add(rule.name)
+    # breadth-first traversal with a shared visited set,
+    #  so each rule in the closure is visited exactly once
+    #  and deep dependency chains can't exhaust the recursion limit.
+    wanted = set([rule_name])
+    queue = collections.deque([rule_name])
+    while queue:
+        rule = rules_by_name[queue.popleft()]
         for dep in rule.get_dependencies(namespaces):
-            rec(rules[dep])
-
-    rec(rules[rule_name])
+            if dep not in wanted:
+                wanted.add(dep)
+                queue.append(dep)
 
-    for rule in rules.values():
+    for rule in rules_by_name.values():
         if rule.name in wanted:
             yield rule
 
@@ -735,6 +1132,9 @@ class RuleSet(object):
     a ruleset is initialized with a collection of rules, which it verifies and sorts into scopes.
     each set of scoped rules is sorted topologically, which enables rules to match on past rule matches.
 
+    pass `keep_definitions=False` to discard the rule source text after construction,
+     which reduces memory usage when `Rule.to_yaml` won't be needed (e.g. match-only services).
+
     example:
 
         ruleset = RuleSet([
@@ -745,49 +1145,163 @@ class RuleSet(object):
         capa.engine.match(ruleset.file_rules, ...)
     """
 
-    def __init__(self, rules):
+    def __init__(self, rules, optimize=True, keep_definitions=True):
         super(RuleSet, self).__init__()
 
         ensure_rules_are_unique(rules)
 
         rules = self._extract_subscope_rules(rules)
 
+        if optimize:
+            # simplify the statement trees so that later matching does less work.
+            # this does not change what the rules match, see `_optimize_statement`.
+            for rule in rules:
+                rule.statement = _optimize_statement(rule.statement)
+                _sort_statement_children(rule.statement)
+
+            _intern_statements(rules)
+
+        # subscope extraction (and optimization) rewrote the statement trees,
+        #  so discard any programs compiled from the earlier form.
+        for rule in rules:
+            rule._program = None
+
         ensure_rule_dependencies_are_met(rules)
 
         if len(rules) == 0:
             raise InvalidRuleSet("no rules selected")
 
-        self.file_rules = self._get_rules_for_scope(rules, FILE_SCOPE)
-        self.function_rules = self._get_rules_for_scope(rules, FUNCTION_SCOPE)
-        self.basic_block_rules = self._get_rules_for_scope(rules, BASIC_BLOCK_SCOPE)
+        # order the rules and compute the dependency closure of the non-lib rules once,
+        #  then bucket the ordered rules by scope,
+        #  rather than re-walking the graph for each of the three scopes.
+        ordered_rules = capa.engine.topologically_order_rules(rules)
+        wanted = self._compute_wanted_rule_names(rules)
+
+        self.file_rules = self._get_rules_for_scope(ordered_rules, wanted, FILE_SCOPE)
+        self.function_rules = self._get_rules_for_scope(ordered_rules, wanted, FUNCTION_SCOPE)
+        self.basic_block_rules = self._get_rules_for_scope(ordered_rules, wanted, BASIC_BLOCK_SCOPE)
         self.rules = {rule.name: rule for rule in rules}
 
+        # all regex features across the rules, for batched string scanning.
+        # the hyperscan database, when available, is compiled on first use, see `match_strings`.
+        self.regexes = _collect_regexes(rules)
+        self._regex_db = None
+
+        if not keep_definitions:
+            # the rule source text is only needed to render rules back out, see `Rule.to_yaml`.
+            # match-only users, like long-running services, can drop it
+            #  to save a few KB of heap per rule.
+            for rule in rules:
+                rule.definition = ""
+
     def __len__(self):
         return len(self.rules)
 
     def __getitem__(self, rulename):
         return self.rules[rulename]
 
-    @staticmethod
-    def _get_rules_for_scope(rules, scope):
+    @classmethod
+    def from_directory(cls, path, workers=None, cache_dir=None, meta_filter=None, **kwargs):
         """
-        given a collection of rules, collect the rules that are needed at the given scope.
-        these rules are ordered topologically.
+        load a RuleSet from the given directory, scanned recursively for *.yml rule files.
+
+        parsing each rule file is independent and CPU bound,
+         so the files are parsed across a pool of worker processes.
+
+        args:
+          path (str): directory containing rule files.
+          workers (int): number of worker processes, defaulting to the CPU count.
+            pass 0 to parse serially, such as when running embedded (e.g. within IDA)
+             where spawning processes is not an option.
+            parsing is also serial where concurrent.futures is unavailable (py2).
+          cache_dir (str): optional on-disk rule cache, see `Rule.from_yaml_file`.
+          meta_filter (callable): optional predicate over a rule's meta mapping.
+            each document's meta section is parsed first, see `Rule.meta_from_yaml_file`,
+             and documents the predicate rejects are skipped without ever
+             paying for full rule parsing.
+            note that dependencies are not resolved at this point,
+             so the predicate must not reject rules that surviving rules `match` on.
+
+        any other keyword arguments are forwarded to the `RuleSet` constructor.
+
+        returns:
+          RuleSet:
+        """
+        rule_paths = []
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                if file.endswith(".yml"):
+                    rule_paths.append(os.path.join(root, file))
 
-        don't include "lib" rules, unless they are dependencies of other rules.
+        # sort for a deterministic rule order, os.walk order varies across systems.
+        rule_paths.sort()
+
+        if meta_filter is not None:
+            rule_paths = [p for p in rule_paths if meta_filter(Rule.meta_from_yaml_file(p))]
+
+        load = functools.partial(Rule.from_yaml_file, cache_dir=cache_dir)
+
+        try:
+            # defer the import: the pool is only needed here.
+            # on py2, concurrent.futures is not in the standard library
+            #  (and the `futures` backport is not a requirement),
+            #  so degrade to parsing serially.
+            import multiprocessing
+            import concurrent.futures
+        except ImportError:
+            workers = 0
+
+        if workers == 0 or len(rule_paths) < 2:
+            rules = list(map(load, rule_paths))
+        else:
+            if workers is None:
+                workers = multiprocessing.cpu_count()
+
+            # batch the files so that workers don't spend their time on result traffic.
+            chunksize = max(1, len(rule_paths) // (8 * workers))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                rules = list(pool.map(load, rule_paths, chunksize=chunksize))
+
+        return cls(rules, **kwargs)
+
+    @staticmethod
+    def _compute_wanted_rule_names(rules):
         """
-        scope_rules = set([])
+        compute the names of all non-lib rules and their transitive dependencies.
 
-        # we need to process all rules, not just rules with the given scope.
-        # this is because rules with a higher scope, e.g. file scope, may have subscope rules
-        #  at lower scope, e.g. function scope.
-        # so, we find all dependencies of all rules, and later will filter them down.
-        for rule in rules:
-            if rule.meta.get("lib", False):
+        we need to process all rules, not just rules with a given scope.
+        this is because rules with a higher scope, e.g. file scope, may have subscope rules
+         at lower scope, e.g. function scope.
+        so, we find all dependencies of all rules, and later will filter them down.
+
+        the closure is computed in a single traversal with a shared visited set,
+         so each rule and edge is handled once,
+         rather than re-walking the graph for every rule.
+        """
+        namespaces = index_rules_by_namespace(rules)
+        rules_by_name = {rule.name: rule for rule in rules}
+
+        wanted = set([])
+        queue = collections.deque(rule.name for rule in rules if not rule.meta.get("lib", False))
+        while queue:
+            name = queue.popleft()
+            if name in wanted:
                 continue
+            wanted.add(name)
+            queue.extend(rules_by_name[name].get_dependencies(namespaces))
 
-            scope_rules.update(get_rules_and_dependencies(rules, rule.name))
-        return get_rules_with_scope(capa.engine.topologically_order_rules(scope_rules), scope)
+        return wanted
+
+    @staticmethod
+    def _get_rules_for_scope(ordered_rules, wanted, scope):
+        """
+        given topologically ordered rules and the names of the wanted rules
+         (see `_compute_wanted_rule_names`),
+        collect the rules that are needed at the given scope, preserving the order.
+
+        don't include "lib" rules, unless they are dependencies of other rules.
+        """
+        return [rule for rule in ordered_rules if rule.name in wanted and rule.scope == scope]
 
     @staticmethod
     def _extract_subscope_rules(rules):
@@ -802,15 +1316,87 @@ class RuleSet(object):
         """
         done = []
 
-        # use a queue of rules, because we'll be modifying the list (appending new items) as we go.
-        while rules:
-            rule = rules.pop(0)
+        # use a queue of rules, because we'll be adding new items (the subscope rules) as we go.
+        # a deque pops from the front in O(1), while list.pop(0) shifts every remaining element.
+        queue = collections.deque(rules)
+        while queue:
+            rule = queue.popleft()
             for subscope_rule in rule.extract_subscope_rules():
-                rules.append(subscope_rule)
+                queue.append(subscope_rule)
             done.append(rule)
 
         return done
 
+    @staticmethod
+    def _compile_regex_database(regexes):
+        """
+        compile all given regex features into a single hyperscan database.
+
+        returns False when the patterns cannot be compiled,
+         such as when one uses a Python `re` construct that hyperscan does not support,
+         so that callers fall back to matching with `re` (and don't retry).
+        """
+        expressions = []
+        ids = []
+        flags = []
+        for i, regex in enumerate(regexes):
+            # `match_strings` feeds the scanner UTF-8 encoded strings,
+            #  so match in UTF-8 mode rather than byte-wise,
+            #  keeping multi-byte characters consistent with the `re` fallback.
+            flag = (
+                hyperscan.HS_FLAG_DOTALL
+                | hyperscan.HS_FLAG_SINGLEMATCH
+                | hyperscan.HS_FLAG_ALLOWEMPTY
+                | hyperscan.HS_FLAG_UTF8
+            )
+            if regex.re.flags & re.IGNORECASE:
+                flag |= hyperscan.HS_FLAG_CASELESS
+            expressions.append(regex.re.pattern.encode("utf-8"))
+            ids.append(i)
+            flags.append(flag)
+
+        db = hyperscan.Database()
+        try:
+            db.compile(expressions=expressions, ids=ids, elements=len(expressions), flags=flags)
+        except hyperscan.error:
+            logger.debug("unable to compile hyperscan database, falling back to re")
+            return False
+        return db
+
+    def match_strings(self, strings):
+        """
+        scan the given strings against every regex feature in this rule set at once.
+
+        when the optional `hyperscan` package is installed, all patterns are compiled
+         into a single database and each string is scanned exactly once;
+         otherwise, each pattern is matched with `re` in turn.
+
+        args:
+          strings (Iterable[str]):
+
+        returns:
+          Set[capa.features.Regex]: the regex features that matched at least one string.
+        """
+        if not self.regexes:
+            return set([])
+
+        if hyperscan is not None and self._regex_db is None:
+            self._regex_db = self._compile_regex_database(self.regexes)
+
+        if self._regex_db:
+            hits = set([])
+
+            def on_match(regex_id, start, end, flags, context):
+                context.add(regex_id)
+
+            for s in strings:
+                self._regex_db.scan(s.encode("utf-8"), match_event_handler=on_match, context=hits)
+
+            return set(self.regexes[i] for i in hits)
+        else:
+            strings = list(strings)
+            return set(regex for regex in self.regexes if any(regex.re.search(s) for s in strings))
+
     def filter_rules_by_meta(self, tag):
         """
         return new rule set with rules filtered based on all meta field values, adds all dependency rules
@@ -456,3 +456,58 @@ def test_render_offset():
     assert str(capa.features.insn.Offset(1)) == "offset(0x1)"
     assert str(capa.features.insn.Offset(1, arch=ARCH_X32)) == "offset/x32(0x1)"
     assert str(capa.features.insn.Offset(1, arch=ARCH_X64)) == "offset/x64(0x1)"
+
+
+def test_compiled_statement():
+    statement = Or(
+        [
+            And([Number(1), Number(2)]),
+            Some(2, [Number(3), Number(4), Number(5)]),
+            Not(Number(6)),
+            Range(Number(7), min=2, max=3),
+        ]
+    )
+    program = compile_statement(statement)
+
+    # the compiled program agrees with the statement tree on a spread of feature sets.
+    feature_sets = [
+        {Number(0): {1}},
+        {Number(1): {1}, Number(2): {1}},
+        {Number(3): {1}, Number(4): {1}},
+        {Number(6): {1}},
+        {Number(6): {1}, Number(7): {1, 2}},
+        {Number(1): {1}, Number(6): {1}},
+    ]
+    for features in feature_sets:
+        assert evaluate_program(program, features) == bool(statement.evaluate(features))
+
+    # subscopes cannot be evaluated, so they cannot be compiled either.
+    try:
+        compile_statement(Subscope("function", Number(1)))
+        assert False
+    except ValueError:
+        pass
+
+
+def test_compiled_statement_regex():
+    statement = And([capa.features.Regex("/abc/")])
+    assert evaluate_program(compile_statement(statement), {String("xx abc yy"): {1}}) == True
+    assert evaluate_program(compile_statement(statement), {String("xx ab yy"): {1}}) == False
+
+
+def test_regex_prefilter():
+    # a required literal is extracted from simple patterns...
+    assert capa.features.Regex("/SELECT.*FROM/").prefilter == "SELECT"
+    assert capa.features.Regex("/VirtualAllocEx?/").prefilter == "VirtualAllocE"
+    assert capa.features.Regex("/fo{2}bar\\.dll/").prefilter == "bar.dll"
+
+    # ...but not when any part might be optional or case-folded.
+    assert capa.features.Regex("/foo|bar/").prefilter is None
+    assert capa.features.Regex("/(foo)?bar/").prefilter is None
+    assert capa.features.Regex("/foobar/i").prefilter is None
+    assert capa.features.Regex("/\\x41BC/").prefilter is None
+
+    # matching behavior is unchanged.
+    assert capa.features.Regex("/SELECT.*FROM/").evaluate({String("x SELECT a FROM b"): {1}}) == True
+    assert capa.features.Regex("/SELECT.*FROM/").evaluate({String("x select a from b"): {1}}) == False
+    assert capa.features.Regex("/VirtualAllocEx?/").evaluate({String("VirtualAllocE"): {1}}) == True
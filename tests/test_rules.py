@@ -6,6 +6,7 @@
 #  is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import os
 import textwrap
 
 import pytest
@@ -282,6 +283,63 @@ def test_subscope_rules():
     assert len(rules.function_rules) == 1
 
 
+def test_keep_definitions():
+    source = textwrap.dedent(
+        """
+        rule:
+            meta:
+                name: test rule
+            features:
+                - api: CreateFileA
+        """
+    )
+
+    rules = capa.rules.RuleSet([capa.rules.Rule.from_yaml(source)])
+    assert rules["test rule"].definition == source
+
+    rules = capa.rules.RuleSet([capa.rules.Rule.from_yaml(source)], keep_definitions=False)
+    assert rules["test rule"].definition == ""
+
+
+def test_subscope_flag():
+    rule = capa.rules.Rule.from_yaml(
+        textwrap.dedent(
+            """
+            rule:
+                meta:
+                    name: test rule
+                features:
+                    - and:
+                        - characteristic: nzxor
+                        - characteristic: switch
+            """
+        )
+    )
+    # parsing records that there's nothing for subscope extraction to do.
+    assert rule._has_subscope == False
+    assert list(rule.extract_subscope_rules()) == []
+
+    rule = capa.rules.Rule.from_yaml(
+        textwrap.dedent(
+            """
+            rule:
+                meta:
+                    name: test rule
+                    scope: file
+                features:
+                    - and:
+                        - characteristic: embedded pe
+                        - function:
+                            - characteristic: nzxor
+            """
+        )
+    )
+    assert rule._has_subscope == True
+    assert len(list(rule.extract_subscope_rules())) == 1
+    # the subscope has been replaced with a `match` statement.
+    assert rule._has_subscope == False
+
+
 def test_duplicate_rules():
     with pytest.raises(capa.rules.InvalidRule):
         rules = capa.rules.RuleSet(
@@ -358,6 +416,20 @@ def test_invalid_rules():
             )
         )
 
+    with pytest.raises(capa.rules.InvalidRule):
+        r = capa.rules.Rule.from_yaml(
+            textwrap.dedent(
+                """
+                rule:
+                    meta:
+                        name: test rule
+                    features:
+                        - and:
+                            - {}
+                """
+            )
+        )
+
 
 def test_number_symbol():
     rule = textwrap.dedent(
@@ -800,3 +872,227 @@ def test_rules_namespace_dependencies():
     assert "rule 1" in r4
     assert "rule 2" in r4
     assert "rule 3" not in r4
+
+
+def test_rule_cache(tmpdir):
+    rule = textwrap.dedent(
+        """
+        rule:
+            meta:
+                name: test rule
+                scope: function
+            features:
+                - and:
+                    - number: 1
+                    - number: 2
+        """
+    )
+    rule_path = tmpdir.join("rule.yml")
+    rule_path.write(rule)
+    cache_dir = tmpdir.join("cache").strpath
+
+    # cold: parse the document and populate the cache.
+    r = capa.rules.Rule.from_yaml_file(rule_path.strpath, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # warm: load the rule from the cache.
+    r = capa.rules.Rule.from_yaml_file(rule_path.strpath, cache_dir=cache_dir)
+    assert r.name == "test rule"
+    assert r.evaluate({Number(1): {1}, Number(2): {1}}) == True
+
+    # a corrupt cache entry must fall back to parsing the document.
+    for entry in os.listdir(cache_dir):
+        with open(os.path.join(cache_dir, entry), "wb") as f:
+            f.write(b"\x00")
+    r = capa.rules.Rule.from_yaml_file(rule_path.strpath, cache_dir=cache_dir)
+    assert r.name == "test rule"
+
+
+def test_optimize_statements():
+    rule = textwrap.dedent(
+        """
+        rule:
+            meta:
+                name: test rule
+            features:
+                - or:
+                    - or:
+                        - number: 1
+                        - number: 1
+                    - not:
+                        - not:
+                            - number: 2
+        """
+    )
+    ruleset = capa.rules.RuleSet([capa.rules.Rule.from_yaml(rule)])
+    statement = ruleset["test rule"].statement
+
+    # or-of-or is flattened, duplicates are dropped, and the double negation is elided,
+    # leaving `or: [number: 1, number: 2]`.
+    assert isinstance(statement, capa.engine.Or)
+    assert len(statement.children) == 2
+    assert statement.children[0] == Number(1)
+    assert statement.children[1] == Number(2)
+
+    assert ruleset["test rule"].evaluate({Number(1): {1}}) == True
+    assert ruleset["test rule"].evaluate({Number(2): {1}}) == True
+    assert ruleset["test rule"].evaluate({Number(3): {1}}) == False
+
+    # the pass can be disabled, preserving the authored tree.
+    ruleset = capa.rules.RuleSet([capa.rules.Rule.from_yaml(rule)], optimize=False)
+    statement = ruleset["test rule"].statement
+    assert isinstance(statement.children[0], capa.engine.Or)
+    assert isinstance(statement.children[1], capa.engine.Not)
+
+
+def test_sort_statement_children():
+    rule = textwrap.dedent(
+        """
+        rule:
+            meta:
+                name: test rule
+            features:
+                - and:
+                    - string: /aaa/
+                    - number: 1
+        """
+    )
+    ruleset = capa.rules.RuleSet([capa.rules.Rule.from_yaml(rule)])
+    statement = ruleset["test rule"].statement
+
+    # the cheap hash-lookup feature is evaluated before the regex scan.
+    assert statement.children[0] == Number(1)
+    assert isinstance(statement.children[1], capa.features.Regex)
+
+
+def test_intern_statements():
+    rules = [
+        capa.rules.Rule.from_yaml(
+            textwrap.dedent(
+                """
+                rule:
+                    meta:
+                        name: rule 1
+                    features:
+                        - and:
+                            - number: 1
+                            - api: CreateFileA
+                """
+            )
+        ),
+        capa.rules.Rule.from_yaml(
+            textwrap.dedent(
+                """
+                rule:
+                    meta:
+                        name: rule 2
+                    features:
+                        - and:
+                            - number: 1
+                            - api: CreateFileA
+                """
+            )
+        ),
+    ]
+    ruleset = capa.rules.RuleSet(rules)
+
+    # the identical logic trees are represented by a single object.
+    assert ruleset["rule 1"].statement is ruleset["rule 2"].statement
+    assert ruleset["rule 1"].evaluate({Number(1): {1}, capa.features.insn.API("CreateFileA"): {2}}) == True
+
+
+def test_match_strings():
+    rules = [
+        capa.rules.Rule.from_yaml(
+            textwrap.dedent(
+                """
+                rule:
+                    meta:
+                        name: rule 1
+                    features:
+                        - string: /SELECT.*FROM/i
+                """
+            )
+        ),
+        capa.rules.Rule.from_yaml(
+            textwrap.dedent(
+                """
+                rule:
+                    meta:
+                        name: rule 2
+                    features:
+                        - string: /VirtualAlloc/
+                """
+            )
+        ),
+    ]
+    ruleset = capa.rules.RuleSet(rules)
+    assert len(ruleset.regexes) == 2
+
+    hits = ruleset.match_strings(["select * from users", "kernel32.CreateFileA"])
+    assert len(hits) == 1
+    assert hits.pop().value == "/SELECT.*FROM/i"
+
+    assert ruleset.match_strings(["nothing interesting"]) == set([])
+
+
+def test_meta_from_yaml():
+    rule = textwrap.dedent(
+        """
+        rule:
+            meta:
+                name: test rule
+                namespace: ns1/nsA
+                scope: function
+            features:
+                - number: 1
+        """
+    )
+    meta = capa.rules.Rule.meta_from_yaml(rule)
+    assert meta["name"] == "test rule"
+    assert meta["namespace"] == "ns1/nsA"
+
+    # meta placed after features still parses, via the full-parse fallback.
+    rule = textwrap.dedent(
+        """
+        rule:
+            features:
+                - number: 1
+            meta:
+                name: test rule
+        """
+    )
+    assert capa.rules.Rule.meta_from_yaml(rule)["name"] == "test rule"
+
+    with pytest.raises(capa.rules.InvalidRule):
+        capa.rules.Rule.meta_from_yaml("foo: [bar")
+
+
+def test_ruleset_from_directory(tmpdir):
+    rule = textwrap.dedent(
+        """
+        rule:
+            meta:
+                name: rule %d
+            features:
+                - number: %d
+        """
+    )
+    tmpdir.join("rule-1.yml").write(rule % (1, 1))
+    tmpdir.mkdir("sub").join("rule-2.yml").write(rule % (2, 2))
+    tmpdir.join("readme.md").write("not a rule")
+
+    # serial
+    ruleset = capa.rules.RuleSet.from_directory(tmpdir.strpath, workers=0)
+    assert len(ruleset) == 2
+    assert ruleset["rule 2"].evaluate({Number(2): {1}}) == True
+
+    # across a worker pool
+    ruleset = capa.rules.RuleSet.from_directory(tmpdir.strpath, workers=2)
+    assert len(ruleset) == 2
+
+    # pre-filtered by meta, so that rejected documents are never fully parsed
+    ruleset = capa.rules.RuleSet.from_directory(
+        tmpdir.strpath, workers=0, meta_filter=lambda meta: meta["name"] == "rule 1"
+    )
+    assert len(ruleset) == 1